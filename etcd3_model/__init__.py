@@ -32,5 +32,6 @@ from .etcd3_model import (
     STATE_DESCRIPTION,
     MESSAGES_DESCRIPTION
 )
+from .wrap_etcd3 import PutEvent, DeleteEvent
 from .utils import clean_desc
 from .config import Config
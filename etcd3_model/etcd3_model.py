@@ -24,9 +24,19 @@ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE."""
 import uuid
 import json
-import inspect
+import logging
 import copy
-from queue import Queue as SimpleQueue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from contextlib import contextmanager
+from enum import Enum
+from queue import SimpleQueue
+try:
+    import orjson
+except ImportError:  # pragma no cover
+    orjson = None
+from .config import Config
 from .utils import clean_desc
 from .lockable import Lockable
 from .wrap_etcd3 import PutEvent
@@ -61,6 +71,234 @@ describe either an object's progress toward 'READY' or
 state.  The 'messages' field provides these in a list of
 strings.""")
 
+if orjson is not None:
+    # The orjson encoder and decoder are C extensions that are much
+    # faster than the standard library ones and work directly with
+    # the bytes that go to and come from ETCD.  They do not handle
+    # everything the standard library does the same way though:
+    # orjson rejects the NaN and Infinity values the standard library
+    # writes for non-finite floats, reads integers that don't fit in
+    # 64 bits as floats, refuses to write those integers and writes
+    # non-finite floats as null.  Whenever that could matter, use the
+    # standard library instead, so that what is stored and read back
+    # is the same whether or not orjson is installed.
+
+    # orjson reads integers that don't fit in 64 bits as floats, so
+    # any integral float at least this big in what it decodes may
+    # have been one of those.
+    _BIG_FLOAT = float(2 ** 63)
+
+    def _has_big_float(value):
+        """Determine whether the decoded JSON list or dictionary 'value'
+        contains, at any depth, an integral float too big to have
+        been read exactly by orjson if it was written as an integer.
+
+        """
+        for item in value.values() if isinstance(value, dict) else value:
+            kind = type(item)
+            if kind is float:
+                if item.is_integer() and abs(item) >= _BIG_FLOAT:
+                    return True
+            elif kind is dict or kind is list:
+                if _has_big_float(item):
+                    return True
+        return False
+
+    def _json_loads(data):
+        """Decode the JSON in 'data' (bytes from ETCD) using orjson, unless
+        orjson can't decode it or might not have decoded it exactly,
+        in which case use the standard library.
+
+        """
+        try:
+            value = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # Could be NaN or Infinity, let the standard library
+            # decide.
+            return json.loads(data)
+        if isinstance(value, (dict, list)) and _has_big_float(value):
+            return json.loads(data)
+        return value
+
+    # Keys the standard library encoder accepts in a dictionary.
+    # orjson also writes others (UUIDs, enums, dates and so on) as
+    # keys when asked to write non-string keys at all.
+    _JSON_KEY_TYPES = (str, int, float, bool, type(None))
+
+    def _has_foreign_value(value):
+        """Determine whether 'value' is, or contains at any depth, a
+        UUID or an enum member (which orjson writes but the standard
+        library encoder refuses), or a dictionary key the standard
+        library encoder refuses.
+
+        """
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if not isinstance(key, _JSON_KEY_TYPES):
+                    return True
+                if _has_foreign_value(item):
+                    return True
+            return False
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                if _has_foreign_value(item):
+                    return True
+            return False
+        return isinstance(value, (uuid.UUID, Enum))
+
+    def _orjson_default(value):
+        """Refuse to encode anything orjson hands back for encoding (dates,
+        times and dataclasses) the way the standard library encoder
+        does.
+
+        """
+        raise TypeError(
+            "Object of type %s is not JSON serializable" %
+            type(value).__name__
+        )
+
+    _ORJSON_OPTIONS = (
+        orjson.OPT_NON_STR_KEYS |
+        orjson.OPT_PASSTHROUGH_DATETIME |
+        orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+
+    def _json_dumps(value):
+        """Encode 'value' as JSON in bytes using orjson.  Like the
+        standard library encoder, allow non-string dictionary keys and
+        refuse dates, times and dataclasses.  If 'value' holds
+        something orjson writes but the standard library encoder
+        refuses, orjson can't encode 'value', or it wrote a null
+        (which it also writes for non-finite floats), use the
+        standard library instead, so the result (or the TypeError) is
+        the same as without orjson.
+
+        """
+        if _has_foreign_value(value):
+            return json.dumps(value)
+        try:
+            data = orjson.dumps(
+                value, default=_orjson_default, option=_ORJSON_OPTIONS
+            )
+        except TypeError:
+            return json.dumps(value)
+        return json.dumps(value) if b"null" in data else data
+else:  # pragma no cover
+    # The standard library decoder also takes bytes directly, so
+    # there is no need to decode what comes from ETCD into a string
+    # first.
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+
+def _message_posted(message, messages):
+    """Determine whether 'message' is found within any of the messages
+    in the list 'messages'.  Rather than searching each message in
+    turn, join them with a separator that can't be part of 'message'
+    and search the result once.
+
+    """
+    if '\0' in message:  # pragma no cover
+        return any(message in msg for msg in messages)
+    return message in '\0'.join(messages)
+
+
+# Watch events from a real ETCD are delivered on the etcd3 client's
+# watch thread, so any time spent handling an event there holds up
+# the whole watch stream.  Hand them off to a single worker thread
+# (which keeps them in order) for decoding and distribution to the
+# watch queues instead.  The mock etcd3 client delivers events
+# synchronously from put() and delete(), and applications' stand-alone
+# tests rely on that, so don't do this with the mock.
+_EVENT_POOL = (
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix="etcd3_model")
+    if not Config.ETCD_MOCK_CLIENT else None
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _log_event_failure(future):
+    """Done callback for events handled on the event worker thread.
+    Nothing waits for the results of those, so log any exception
+    raised handling an event instead of letting it vanish with the
+    future.
+
+    """
+    exception = future.exception()
+    if exception is not None:
+        LOGGER.error(
+            "failed to handle ETCD watch event", exc_info=exception
+        )
+
+
+# The maximum number of operations ETCD accepts in a single
+# transaction (the ETCD default for --max-txn-ops).
+MAX_TXN_OPS = 128
+
+# Per thread state for Etcd3Model.batched().  While a thread is
+# batching puts, 'pending' is a dictionary of the latest JSON string to
+# be stored at each ETCD key (along with the ETCD instance to store it
+# in), indexed by the identity of the ETCD instance and the key (the
+# same key may be used in more than one ETCD instance), otherwise it is
+# None.
+_BATCH = threading.local()
+
+
+def _write_batch(pending):
+    """Store all of the puts in 'pending' (see _BATCH above) using as few
+    ETCD transactions as possible.
+
+    """
+    by_etcd = {}
+    for (_, key), (etcd, json_string) in pending.items():
+        puts = by_etcd.setdefault(id(etcd), (etcd, []))[1]
+        puts.append(etcd.transactions.put(key, json_string))
+    for etcd, puts in by_etcd.values():
+        for start in range(0, len(puts), MAX_TXN_OPS):
+            etcd.transaction(compare=[],
+                             success=puts[start:start + MAX_TXN_OPS],
+                             failure=[])
+
+
+# Scalar types whose values can never be changed in place, so they can
+# be shared freely.  Note that 'bool' is a subclass of 'int'.
+_SCALAR_TYPES = (int, float, complex, str, bytes, type(None))
+
+
+def _is_immutable(value):
+    """Determine whether 'value' and anything it contains can never be
+    changed in place.
+
+    """
+    if isinstance(value, _SCALAR_TYPES):
+        return True
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(item) for item in value)
+    return False
+
+
+def _no_copy(value):
+    """The 'copy' of an immutable value is the value itself.
+
+    """
+    return value
+
+
+def _default_copier(default):
+    """Choose the cheapest function that will make a copy of the
+    non-callable 'default' that shares nothing mutable with 'default'.
+
+    """
+    if _is_immutable(default):
+        return _no_copy
+    if type(default) in (list, set) and _is_immutable(tuple(default)):
+        return type(default).copy
+    # pylint: disable=unidiomatic-typecheck
+    if type(default) is dict and _is_immutable(tuple(default.values())):
+        return dict.copy
+    return copy.deepcopy
+
 
 class Etcd3Attr:
     """Etcd3 Attribute Specification
@@ -108,6 +346,15 @@ class Etcd3Attr:
     not specify a 'default' setting is assigned a value of None if it
     is not specified at instance creation time.
 
+    A non-callable default value is copied for each instance so that
+    instances never share a mutable default.  For mutable defaults
+    (lists, dictionaries and so forth) it is cheaper to supply a
+    callable that makes a new one, for example:
+
+        class MyModel(Etcd3Model):
+            my_list = Etcd3Attr(default=list)
+            ...
+
     """
     @staticmethod
     def _default_object_id():
@@ -143,6 +390,18 @@ class Etcd3Attr:
                 default = Etcd3Attr._default_object_id
         self.default = default
         self.is_object_id = is_object_id
+        # Work out how to produce a default value now, rather than
+        # every time one is needed.
+        self._default_is_callable = callable(default)
+        self._copy_default = (
+            None if self._default_is_callable else _default_copier(default)
+        )
+        # A callable taking no arguments that produces the default
+        # value, for use where defaults are needed in bulk (see
+        # Etcd3Model.__init__()).
+        self.default_factory = (
+            default if self._default_is_callable else self.get_default_value
+        )
 
     def get_default_value(self):
         """Obtain the default value for a field (either by calling a callable
@@ -150,17 +409,28 @@ class Etcd3Attr:
         default setting.
 
         """
-        default = self.default
-        if callable(default):
-            return default()
+        if self._default_is_callable:
+            return self.default()
         # For any non-callable, make sure that we are not
         # replicating the same object, list, dictionary, or
         # whatever across all objects of this type by using what
-        # is there as a template, but not the actual thing.  A
-        # little bit of overhead for scalars, but safer for all
-        # concerned.
-        default = copy.deepcopy(default)
-        return default
+        # is there as a template, but not the actual thing.
+        # Immutable values are shared, flat containers of immutable
+        # values get a shallow copy and anything else gets a deep
+        # copy.
+        return self._copy_default(self.default)
+
+
+# The state of a derived model class worked out from its
+# 'model_prefix' and 'etcd_instance' (see
+# Etcd3Model._model_state()), along with the 'model_prefix' and
+# 'etcd_instance' it was worked out from.
+_ModelState = namedtuple(
+    '_ModelState', [
+        'model_prefix', 'etcd_instance', 'key_prefix', 'watch_start',
+        'watch_end', 'model_error',
+    ]
+)
 
 
 class Etcd3Model(Lockable):
@@ -278,7 +548,15 @@ class Etcd3Model(Lockable):
     """
     # Set up 'state' and 'messages'
     state = Etcd3Attr(default=UPDATING)
-    messages = Etcd3Attr(default=[])
+    messages = Etcd3Attr(default=list)
+
+    # What __init_subclass__() works out for each derived model
+    # class.  Etcd3Model itself can't be instantiated, but trying to
+    # should fail the same way as for any other model class missing
+    # its required class attributes, so give it these too.
+    _attr_specs = {}
+    _attr_defaults = ()
+    _oid_name = None
 
     @classmethod
     def post_event(cls, event):
@@ -286,7 +564,20 @@ class Etcd3Model(Lockable):
         discarding it (if it is a DeleteEvent or a PutEvent for an
         object in the READY state) or constructing an object of the
         type specified in 'cls' and sending it down all of the watch
-        queues for that type.
+        queues for that type.  When using a real ETCD, the work is
+        done on a separate thread so that the etcd3 watch thread that
+        calls this is not held up.
+
+        """
+        if _EVENT_POOL is not None:  # pragma no unit test
+            future = _EVENT_POOL.submit(cls._handle_event, event)
+            future.add_done_callback(_log_event_failure)
+            return
+        cls._handle_event(event)
+
+    @classmethod
+    def _handle_event(cls, event):
+        """Do the work of post_event() for 'event'.
 
         """
         obj = None
@@ -294,34 +585,31 @@ class Etcd3Model(Lockable):
             # The object was modified, pack up a new object of the
             # specified class with the new value and put it on the
             # queue
-            json_string = event.value.decode('utf-8')
-            class_dict = json.loads(json_string)
+            class_dict = _json_loads(event.value)
+            # Objects that are in the READY state do not need to be
+            # sent down the watch queues.  Any object that contains an
+            # update or deletion request will be marked UPDATING or or
+            # DELETING.  READY is the state it arrives in when it
+            # finishes UPDATING.  So, keep the traffic lower by
+            # tossing READY objects here, before going to the trouble
+            # of constructing them.
+            if class_dict.get('state') == READY:
+                return
             obj = cls(class_dict)
         else:
             # For the time being, we don't care about DeleteEvents
             # because the controllers will initiate all of them.  To
             # cut down on unwanted event traffic to the controllers,
             # and to keep the controllers simple, just toss anything
-            # that is not a PutEvent
-            return
-        # Objects that are in the READY state do not need to be sent
-        # down the watch queues.  Any object that contains an update
-        # or deletion request will be marked UPDATING or or DELETING.
-        # READY is the state it arrives in when it finishes UPDATING.
-        # So, keep the traffic lower by tossing READY objects here.
-        if obj.state == READY:
+            # that is not a PutEvent.
             return
 
         # Should not be able to get here without having defined
         # 'watch_queues' in 'cls', but to be safe, we don't really
         # care if this gets called before there are any queues, we can
         # just drop the event on the floor.
-        try:
-            for queue in cls.watch_queues:
-                queue.put(obj)
-        except AttributeError:  # pragma no cover
-            # No big deal, no watch_queues yet, so nothing to do.
-            pass
+        for queue in vars(cls).get('watch_queues', ()):
+            queue.put(obj)
 
     @classmethod
     def get(cls, object_id):
@@ -356,15 +644,12 @@ class Etcd3Model(Lockable):
                 my_model = MyModel.get('89e50500-f3b6-4818-982d-cc589dea8be5')
 
         """
-        etcd = cls.etcd_instance  # pylint: disable=no-member
-        # pylint: disable=no-member
-        key = "%s/%s" % (cls.model_prefix, object_id)
-        json_data, _ = etcd.get(key)
+        state = cls._model_state()
+        key = state.key_prefix + str(object_id)
+        json_data, _ = state.etcd_instance.get(key)
         if json_data is None:
             return None
-        json_string = json_data.decode('utf-8')
-        class_dict = json.loads(json_string)
-        return cls(class_dict)
+        return cls(_json_loads(json_data))
 
     @classmethod
     def get_all(cls):
@@ -381,21 +666,21 @@ class Etcd3Model(Lockable):
 
             A list of model objects of the derived class.
         """
-        etcd = cls.etcd_instance  # pylint: disable=no-member
-        prefix = cls.model_prefix + '/'  # pylint: disable=no-member
-        objects = etcd.get_prefix(prefix)
-        ret = []
-        for obj in objects:
-            json_string = obj[0].decode('utf-8')
-            class_dict = json.loads(json_string)
-            ret += [cls(class_dict)]
-        return ret
+        state = cls._model_state()
+        return [
+            cls(_json_loads(json_data))
+            for json_data, _ in state.etcd_instance.get_prefix(
+                state.key_prefix
+            )
+        ]
 
     @classmethod
     def watch(cls):
         """Create a watch queue to watch for ETCD events on objects in the
         derived class 'cls'.  All events on ETCD KVs with the model
-        prefix will be delivered on the queue.
+        prefix will be delivered on the queue.  The queue is a
+        queue.SimpleQueue (an unbounded FIFO queue that does not
+        support task tracking with task_done() or join()).
 
         NOTE: this is not thread-safe. It assumes that the callers of
               watch() are all in one overall controller thread.  At
@@ -406,38 +691,93 @@ class Etcd3Model(Lockable):
 
         """
         new_queue = SimpleQueue()
+        # Look for watch queues belonging to this class itself, not
+        # inherited from a watched base class.
+        queues = vars(cls).get('watch_queues')
+        if queues is None:
+            # We haven't set up for watch queues yet.  Set up the
+            # watch callback on the range of keys holding objects of
+            # this class.  Hang onto the watch ID we get for it so we
+            # can cancel it later if we want to for some reason.
+            #
+            state = cls._model_state()
+            cls.watch_id = state.etcd_instance.add_watch_callback(
+                state.watch_start, cls.post_event, range_end=state.watch_end
+            )
+            queues = ()
+        # Watch queues are kept in a tuple that is replaced whenever a
+        # queue is added, watches are rare compared to the events sent
+        # down the queues.
+        cls.watch_queues = queues + (new_queue,)
+        return new_queue
+
+    @staticmethod
+    @contextmanager
+    def batched():
+        """Context manager that collects all of the put() operations done
+        (by this thread) on any model objects within the managed
+        context and stores them to ETCD together, in as few
+        transactions as possible, when the context exits normally.  If
+        the same object is stored more than once within the context,
+        only its last state is stored.  This saves a round trip (and
+        an ETCD commit) per put when an object is updated several
+        times in a row, or when many objects are updated at once.
+
+        Example:
+
+            with MyModel.batched():
+                my_model.post_message("step one done")
+                my_model.post_message("step two done")
+                my_model.set_ready()
+
+        NOTE: objects stored within the managed context are not
+              visible in ETCD (to get(), get_all() or watchers) until
+              the context exits.  Batched contexts may be nested, in
+              which case the puts are stored when the outermost
+              context exits.
+
+        NOTE: if the managed context exits with an exception, the
+              puts collected in it are discarded, not stored.
+
+        NOTE: the puts are not guaranteed to be stored atomically.
+              There is one transaction per ETCD instance for every
+              MAX_TXN_OPS (the ETCD limit on operations in one
+              transaction) objects stored, so a batch of more objects
+              than that is stored in several transactions.
+
+        """
+        if getattr(_BATCH, 'pending', None) is not None:
+            # Already batching, let the outermost context do the
+            # storing.
+            yield
+            return
+        _BATCH.pending = {}
         try:
-            cls.watch_queues.append(new_queue)
-            return new_queue
-        except AttributeError:
-            # We haven't set up for watch queues yet.  Since the above
-            # will return if it works, the rest of this function is
-            # effectively the exception case, just pass here so we
-            # can get out of exception handling.
-            pass
-
-        # First off, we need a list for watch queues, and we might as
-        # well put the queue we have in it right away.
-        cls.watch_queues = [new_queue]
-
-        # Set up a watch range that covers all of the items that fit in:
-        #
-        #      <model_prefix>/<item>
-        #
-        # This is done by adding a '/' to the prefix for the start and
-        # adding the character one past '/' for the end.  All keys we
-        # want will fall in that range of strings.
-        start = cls.model_prefix + '/'  # pylint: disable=no-member
-        end = cls.model_prefix + chr(ord('/') + 1)  # pylint: disable=no-member
+            yield
+        except BaseException:
+            _BATCH.pending = None
+            raise
+        pending = _BATCH.pending
+        _BATCH.pending = None
+        _write_batch(pending)
 
-        # Set up the watch callback.  Hang onto the watch ID we get for it
-        # so we can cancel it later if we want to for some reason.
-        #
-        # pylint: disable=no-member
-        cls.watch_id = cls.etcd_instance.add_watch_callback(start,
-                                                            cls.post_event,
-                                                            range_end=end)
-        return new_queue
+    @staticmethod
+    def put_many(objects):
+        """Store all of the model objects in 'objects' to ETCD together,
+        the same way a batched() context would (see the notes there),
+        instead of with one put per object.
+
+        Parameters:
+
+        objects
+
+            An iterable of model objects (of any model classes) to be
+            stored.
+
+        """
+        with Etcd3Model.batched():
+            for obj in objects:
+                obj.put()
 
     @classmethod
     def learn(cls):
@@ -455,134 +795,223 @@ class Etcd3Model(Lockable):
                 obj.state = UPDATING
             obj.post_message("Learning initiated")
 
-    def _get_instance_attrs(self):
-        """Build a dictionary of instance attributes and their respective
-        specifications.
+    def __init_subclass__(cls, **kwargs):
+        """Work out the instance attribute specifications, the name of the
+        Object ID attribute and the validity of a derived model class
+        once, when the class is created, so that they do not have to
+        be rediscovered on every operation (the state derived from
+        'model_prefix' and 'etcd_instance' is worked out when it is
+        needed, since those may be set later, see _model_state()).  A
+        derived model class that is not valid is not reported here
+        (it may be a base for other model classes), it is reported
+        when an instance of the class is created.
 
         """
-        ret = {}
-        members = inspect.getmembers(type(self))
-        for member in members:
-            if isinstance(member[1], Etcd3Attr):
-                ret[member[0]] = member[1]
-        return ret
+        super().__init_subclass__(**kwargs)
+        attr_specs = {}
+        # Walk the class hierarchy from the most basic class to the
+        # most derived so that derived classes override their bases.
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                if isinstance(value, Etcd3Attr):
+                    attr_specs[attr] = value
+                else:
+                    attr_specs.pop(attr, None)
+        cls._attr_specs = attr_specs
+        cls._attr_defaults = tuple(
+            (attr, spec.default_factory) for attr, spec in attr_specs.items()
+        )
+        oid_names = [
+            attr for attr, spec in attr_specs.items() if spec.is_object_id
+        ]
+        cls._oid_name = oid_names[0] if len(oid_names) == 1 else None
 
-    def _get_object_id_info(self):
-        """Find the name of the field specified to contain the Object ID in
-        instances of the derived model class (if any).
+    @classmethod
+    def _model_state(cls):
+        """Get the key prefix, watch range and validity of a derived model
+        class (see _ModelState).  These are worked out from the
+        'model_prefix' and 'etcd_instance' of the class the first time
+        they are needed and kept on the class, then worked out again
+        whenever 'model_prefix' or 'etcd_instance' is no longer what
+        they were worked out from (for example, because one was set on
+        the class after it was defined).  A watch that was already set
+        up on the class keeps watching the old prefix.
+
+        """
+        model_prefix = getattr(cls, 'model_prefix', None)
+        etcd_instance = getattr(cls, 'etcd_instance', None)
+        # Only state worked out for this class itself will do, state
+        # inherited from a base class is about the base class.
+        state = cls.__dict__.get('_derived_state')
+        if state is not None and \
+           state.model_prefix is model_prefix and \
+           state.etcd_instance is etcd_instance:
+            return state
+        # All keys of objects in this class start with the same
+        # prefix, compose it now, not every time a key is needed.
+        key_prefix = model_prefix + '/' if model_prefix is not None else None
+        # Likewise, the range of keys to watch (see watch()) covers all
+        # of the items that fit in:
+        #
+        #      <model_prefix>/<item>
+        #
+        # This is done by adding a '/' to the prefix for the start and
+        # adding the character one past '/' (which is '0') for the
+        # end.  All keys we want will fall in that range of strings.
+        watch_end = model_prefix + '0' if model_prefix is not None else None
+        oid_count = sum(
+            1 for spec in cls._attr_specs.values() if spec.is_object_id
+        )
+        state = _ModelState(
+            model_prefix, etcd_instance, key_prefix, key_prefix, watch_end,
+            cls._find_model_error(oid_count)
+        )
+        cls._derived_state = state
+        return state
+
+    @classmethod
+    def _find_model_error(cls, oid_count):
+        """Check that the derived model class 'cls' with 'oid_count'
+        instance attributes tagged as the Object ID can be
+        instantiated.
 
         Returns:
-            A tuple containing the name of the field and the
-            attribute specification associated with that name.
 
-        Exceptions:
+            None if the class is valid, otherwise a tuple containing the
+            exception class and the reason to raise when an instance of
+            the class is created:
+
+            If a required class attribute ('etcd_instance' or
+            'model_prefix') is missing from the derived class, an
+            AttributeError exception.
 
-            If more than instance attribute is tagged as the Object ID
-            in the derived class, an AssertionError exception is
-            raised.
+            If more than one instance attribute is tagged as the Object ID
+            in the derived class, an AssertionError exception.
 
             If no instance attribute is tagged as the Object ID
-            in the derived class, an AttributeError exception is
-            raised.
+            in the derived class, an AttributeError exception.
 
         """
-        ret = None
-        attrs = self._get_instance_attrs()
-        for attr, spec in attrs.items():
-            if spec.is_object_id:
-                if ret is not None:
-                    # pylint: disable=invalid-name
-                    t = str(type(self))
-                    reason = "can't have two Object IDs in '%s'" % t
-                    raise AssertionError(reason)
-                ret = (attr, spec)
-        if ret is None:
-            # pylint: disable=invalid-name
-            t = str(type(self))
-            reason = "must have an Object ID in '%s'" % t
-            raise AttributeError(reason)
-        return ret
+        # pylint: disable=invalid-name
+        t = str(cls)
+        for name in ['etcd_instance', 'model_prefix']:
+            if name not in cls.__dict__:
+                reason = "'%s' missing required attribute '%s'" % (t, name)
+                return (AttributeError, reason)
+        if oid_count > 1:
+            return (AssertionError, "can't have two Object IDs in '%s'" % t)
+        if oid_count == 0:
+            return (AttributeError, "must have an Object ID in '%s'" % t)
+        return None
 
     def __init__(self, *args, **kwargs):
         """Initializer -- construct a model from keyword arguments or a
         dictionary of key value pairs.
         """
-        # Make sure that all of the required pieces are specified as
-        # class attributes in the derived class we are constructing.
-        # Raise an AttributeError if any are missing.
-        for name in ['etcd_instance', 'model_prefix']:
-            if name not in type(self).__dict__:
-                # pylint: disable=invalid-name
-                t = str(type(self))
-                reason = "'%s' missing required attribute '%s'" % (t, name)
-                raise AttributeError(reason)
-
-        # Make sure there is an object-id field specified (the call
-        # will exception if none is present).  Ignore the return.
-        self._get_object_id_info()
-
-        # Get the declared instance attribute specifications for use
-        # in validating input and in filling out defaults.
-        attr_specs = self._get_instance_attrs()
+        cls = type(self)
+        # Make sure that all of the required pieces are specified in
+        # the derived class we are constructing (this is only checked
+        # again when they change).  Raise the appropriate exception if
+        # not.
+        state = cls._model_state()
+        if state.model_error is not None:
+            exception, reason = state.model_error
+            raise exception(reason)
 
         # Pick up any dictionary arguments provided with the call and
-        # absorb any key / value pairs found there.
+        # any settings that came in as keyword args.
+        supplied = {}
         for arg_dict in args:
-            for attr, value in arg_dict.items():
-                # Only take key / value pairs that are recognized,
-                # drop others silently.
-                if attr in attr_specs:
-                    setattr(self, attr, value)
-
-        # Pick up any settings that came in as keyword args
-        for attr, value in kwargs.items():
-            # Only take key / value pairs that are recognized,
-            # drop others silently.
-            if attr in attr_specs:
-                setattr(self, attr, value)
-
-        # Now run through the list of instance attributes and create
-        # any that were not specified in the call.  This will also
-        # take care of setting the Object ID if no Object ID attribute
-        # was specified in the call, since one of the instance
-        # attributes has to be the Object ID.
-        for attr, spec in attr_specs.items():
-            if attr not in self.__dict__:
-                setattr(self, attr, spec.get_default_value())
+            supplied.update(arg_dict)
+        supplied.update(kwargs)
+
+        # Now run through the list of instance attributes and set each
+        # one either to the value supplied in the call or, if none
+        # was supplied, to its default.  Supplied values that are not
+        # recognized are dropped silently.  This will also take care
+        # of setting the Object ID if no Object ID attribute was
+        # specified in the call, since one of the instance attributes
+        # has to be the Object ID.
+        #
+        # Setting the attributes in the same (declaration) order in
+        # every instance, no matter what order they were supplied in,
+        # lets all of the instances of the class share one attribute
+        # layout (key-sharing instance dictionaries, which versions
+        # of Python before 3.11 only share when the order matches).
+        # Declared attributes are plain instance attributes (Etcd3Attr
+        # is not a descriptor), so they are stored straight into the
+        # instance dictionary.
+        values = self.__dict__
+        for attr, default_factory in cls._attr_defaults:
+            values[attr] = (
+                supplied[attr] if attr in supplied else default_factory()
+            )
 
         # Set up the locking for the instance, now that we know the
         # etcd instance, prefix and object id of the instance.
-        model_prefix = type(self).__dict__['model_prefix']
-        etcd_instance = type(self).__dict__['etcd_instance']
-        name = "%s/%s" % (model_prefix, str(self.get_id()))
-        Lockable.__init__(self, name, etcd_instance)
+        name = state.key_prefix + str(self.get_id())
+        Lockable.__init__(self, name, state.etcd_instance)
 
     def get_id(self):
         """ Get the object id (key) of an object
         """
-        oid_name, _ = self._get_object_id_info()
-        return self.__dict__[oid_name]
+        return self.__dict__[type(self)._oid_name]
 
-    def delete(self, message=None):
-        """Set the object state to DELETING with an optional message which
-        will be put in 'messages' and update it in ETCD.
+    def mutate(self, state=None, append_messages=None, set_ready=False):
+        """Make any combination of the standard changes to the object and
+        then update it in ETCD with a single put().  The changes are
+        applied in the order of the parameters below:
+
+            set_ready:
+
+                If True, clear any messages and set the state to
+                READY, as set_ready() does.
+
+            state:
+
+                If set, the new state of the object.
+
+            append_messages:
+
+                If set, a list of (non-empty string) messages to be
+                added to the end of 'messages'.
 
         """
-        if message:
+        # Check the messages before changing anything, so a bad message
+        # leaves the object as it was.
+        append_messages = list(append_messages or [])
+        for message in append_messages:
             assert isinstance(message, str)  # disallow non-string messages
-            self.messages.append(message)  # pylint: disable=no-member
-        self.state = DELETING
+            assert message  # Disallow empty messages
+        if set_ready:
+            self.messages = []
+            self.state = READY
+        if state is not None:
+            self.state = state
+        self.messages.extend(append_messages)  # pylint: disable=no-member
         self.put()
 
+    def delete(self, message=None):
+        """Set the object state to DELETING with an optional message (or
+        list of messages) which will be put in 'messages' and update
+        it in ETCD with a single put().
+
+        """
+        if isinstance(message, str):
+            message = [message]
+        # disallow anything but a string or list of messages
+        assert message is None or isinstance(message, list)
+        # Empty messages are tolerated (and dropped) here
+        messages = [msg for msg in message or [] if msg]
+        self.mutate(state=DELETING, append_messages=messages)
+
     def post_message(self, message):
         """Post a caller supplied message in the 'messages' list of the
         object and update the object in ETCD.
 
         """
         assert isinstance(message, str)  # disallow non-string messages
-        assert message  # Disallow empty messages
-        self.messages.append(message)  # pylint: disable=no-member
-        self.put()
+        self.mutate(append_messages=[message])
 
     def post_message_once(self, message):
         """Post a caller supplied message in the 'messages' list of the object
@@ -592,34 +1021,41 @@ class Etcd3Model(Lockable):
         """
         assert isinstance(message, str)  # disallow non-string messages
         assert message  # Disallow empty messages
-        for msg in self.messages:
-            if message in msg:
-                # Already have it, just update and return
-                self.put()
-                return
+        if _message_posted(message, self.messages):
+            # Already have it, just update and return
+            self.put()
+            return
         self.messages.append(message)  # pylint: disable=no-member
         self.put()
 
     def put(self):
         """ Store the object to ETCD in its current state.
         """
-        oid_name, _ = self._get_object_id_info()
-        object_id = self.__dict__[oid_name]
-        etcd = type(self).etcd_instance  # pylint: disable=no-member
-        # pylint: disable=no-member
-        key = "%s/%s" % (type(self).model_prefix, object_id)
+        # pylint: disable=protected-access
+        cls = type(self)
+        values = self.__dict__
+        object_id = values[cls._oid_name]
+        state = cls._model_state()
+        etcd = state.etcd_instance
+        key = state.key_prefix + str(object_id)
         # Compose the JSON string to be stored for this model.  Only
         # include in the JSON string the fields that are declared in
         # the model attribute specification.  Any other fields that
         # might exist are treated as ephemeral.  This allows us to
         # keep track of and report run-time information in schemas
         # built on this model without having to persist run-time data.
-        put_dict = {}
-        attr_specs = self._get_instance_attrs()
-        for attr, spec in self.__dict__.items():
-            if attr in attr_specs:
-                put_dict[attr] = spec
-        json_string = json.dumps(put_dict)
+        put_dict = {
+            attr: values[attr] for attr in cls._attr_specs if attr in values
+        }
+        json_string = _json_dumps(put_dict)
+        pending = getattr(_BATCH, 'pending', None)
+        if pending is not None:
+            # Batching puts, replace any earlier state of this object
+            # with the current one and store it later.
+            index = (id(etcd), key)
+            pending.pop(index, None)
+            pending[index] = (etcd, json_string)
+            return
         etcd.put(key, json_string)
 
     def set_ready(self):
@@ -627,16 +1063,17 @@ class Etcd3Model(Lockable):
         state to READY.
 
         """
-        self.messages = []
-        self.state = READY
-        self.put()
+        self.mutate(set_ready=True)
 
     def remove(self):
         """ Remove the ETCD instance from the key value store.
         """
-        oid_name, _ = self._get_object_id_info()
-        object_id = self.__dict__[oid_name]
-        etcd = type(self).etcd_instance  # pylint: disable=no-member
-        # pylint: disable=no-member
-        key = "%s/%s" % (type(self).model_prefix, object_id)
+        object_id = self.__dict__[type(self)._oid_name]
+        state = type(self)._model_state()
+        etcd = state.etcd_instance
+        key = state.key_prefix + str(object_id)
+        pending = getattr(_BATCH, 'pending', None)
+        if pending is not None:
+            # Don't let a batched put bring the object back.
+            pending.pop((id(etcd), key), None)
         etcd.delete(key)
@@ -23,17 +23,30 @@ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
 ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 """
+import threading
 from .config import Config
 from .wrap_etcd3 import client
 
+# Clients that have already been created, indexed by (host, port), so
+# that every caller talking to the same ETCD shares one connection.
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
 
 def create_instance():
-    """Create a new etcd3 client using the configured ETCD_HOST and
+    """Obtain an etcd3 client using the configured ETCD_HOST and
     ETCD_PORT values set by:
 
          etcd3_model.Config(configuration)
 
-    which should have been called before this method is called.
+    which should have been called before this method is called.  The
+    client is created the first time this is called for a given host
+    and port, after that the same client is returned, so calling this
+    more than once does not open more connections to ETCD.
 
     """
-    return client(Config.ETCD_HOST, Config.ETCD_PORT)
+    index = (Config.ETCD_HOST, Config.ETCD_PORT)
+    with _CLIENTS_LOCK:
+        if index not in _CLIENTS:
+            _CLIENTS[index] = client(*index)
+        return _CLIENTS[index]
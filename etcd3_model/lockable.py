@@ -22,6 +22,7 @@ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
 OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
 ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE."""
+import asyncio
 
 
 class LockHolder:
@@ -29,6 +30,8 @@ class LockHolder:
     on the acquisition for non-blocking lock checks.
 
     """
+    __slots__ = ('my_lock', 'timeout')
+
     def __init__(self, etcd, name, ttl=60, timeout=None):
         """ Constructor
 
@@ -42,7 +45,10 @@ class LockHolder:
         be used for the acquisition.
 
         """
-        self.my_lock.acquire(self.timeout)
+        # Always pass the timeout, even when it is None: etcd3 locks
+        # only wait forever when told to explicitly and otherwise give
+        # up after 10 seconds, whatever the TTL.
+        self.my_lock.acquire(timeout=self.timeout)
         return self
 
     def release(self):
@@ -72,6 +78,31 @@ class LockHolder:
         return False
 
 
+class AsyncLockHolder(LockHolder):
+    """A LockHolder for use with 'async with'.  Acquiring and releasing
+    the lock block (acquiring for up to the timeout), so both are run
+    in the event loop's default executor to keep them from stalling
+    the event loop.
+
+    """
+    __slots__ = ()
+
+    async def __aenter__(self):
+        """Acquire the lock as an asynchronous context manager.
+
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.acquire)
+
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        """ Release the lock at the end of an asynchronous managed context.
+
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.release)
+        return False
+
+
 class Lockable:
     """Base class with a lock() method that produces distinct locks per
     object-id in ETCD for use with 'with'.  Call the lock() method on an
@@ -138,3 +169,12 @@ class Lockable:
 
         """
         return LockHolder(self.etcd, self.name, ttl, timeout)
+
+    def async_lock(self, ttl=60, timeout=None):
+        """Method to use with the 'async with' statement for locking the
+        instance resource from asyncio code.  This works just like
+        lock() (and takes the same parameters) except that waiting
+        for the lock does not block the event loop.
+
+        """
+        return AsyncLockHolder(self.etcd, self.name, ttl, timeout)
@@ -26,12 +26,11 @@ OTHER DEALINGS IN THE SOFTWARE.
 """
 import re
 
+_WHITESPACE_RE = re.compile(r"\s+")
+
 
 def clean_desc(desc):
     """Clean up whitespace in description strings.
 
     """
-    clean = re.sub(r"\s+", " ", desc)
-    clean = re.sub(r"^\s+", "", clean)
-    clean = re.sub(r"\s+$", "", clean)
-    return clean
+    return _WHITESPACE_RE.sub(" ", desc).strip()
@@ -23,15 +23,51 @@ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
 ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE."""
 import threading
-from time import time, sleep
+from functools import lru_cache
+from bisect import bisect_left, bisect_right, insort
+from time import monotonic
 from .events import PutEvent, DeleteEvent
 
 
+def _value_bytes(value):
+    """Like etcd3, accept values to be stored as either str or bytes, and
+    store them as bytes.
+
+    """
+    return value if isinstance(value, bytes) else bytes(value, 'utf-8')
+
+
+def _prefix_range_end(prefix):
+    """Return the first key (as bytes) after all of the keys that start
+    with 'prefix' (also bytes), the way etcd3 computes the end of a
+    prefix range: drop any trailing 0xff bytes and increment the last
+    byte left.  If nothing is left, every key after 'prefix' starts
+    with it and None is returned.
+
+    """
+    prefix = prefix.rstrip(b'\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes((prefix[-1] + 1,))
+
+
+@lru_cache(maxsize=4096)
+def _key_bytes(key):
+    """Like etcd3, accept keys as either str or bytes, and use them as
+    bytes.  Keys are short and the same ones are used over and over,
+    so remember the encoded form instead of encoding on every call.
+
+    """
+    return _value_bytes(key)
+
+
 class CommonLock:
     """A mock version of the shared mechanism underlying the etcd3 Lock
     object.  There is one of these per named lock.
 
     """
+    __slots__ = ('state', 'name', 'ttl', 'etcd_client', 'cond')
+
     def __init__(self, name, ttl=60, etcd_client=None):
         """Constructor
 
@@ -53,57 +89,73 @@ class CommonLock:
         """
         # Each successful acquisition gets a unique number (always
         # incremented) which it uses to claim ownership in checking
-        # for is_acquired() or for releasing() the lock.
-        self.acquire_counter = 0
+        # for is_acquired() or for releasing() the lock.  Release
+        # times are on the monotonic clock so that TTLs are not
+        # thrown off by changes to the system clock.  The current
+        # acquisition number and release time are kept together in
+        # the tuple 'state', which is only ever replaced as a whole
+        # (under the condition lock), so that reading it once gives
+        # a consistent view of the lock without locking.
+        self.state = (0, None)
         self.name = name
         self.ttl = ttl
         self.etcd_client = etcd_client
-        self.release_time = None
-        # used for thread safety, not part of the mechanism:
-        self.thread_lock = threading.Lock()
+        # used for thread safety and for waking up threads waiting to
+        # acquire the lock when it is released, not part of the
+        # mechanism:
+        self.cond = threading.Condition()
 
     def is_acquired(self, owner_counter):
         """Determine whether the lock is currently being held or not (i.e. TTL
         is there and not expired).
 
         """
-        if owner_counter != self.acquire_counter:
+        acquire_counter, release_time = self.state
+        if owner_counter != acquire_counter:
             # Not the owner of the lock
             return False
-        with self.thread_lock:
-            if self.release_time is not None and self.release_time >= time():
-                return True
-        return False
+        return release_time is not None and release_time >= monotonic()
 
     def acquire(self, timeout=None):
         """Acquire the lock using the specified timeout and the lock's TTL
         value.
 
         """
-        give_up = time() + timeout if timeout is not None else None
-        while True:
-            with self.thread_lock:
-                if self.release_time is None or self.release_time < time():
+        clock = monotonic  # looked up once for the whole loop
+        give_up = clock() + timeout if timeout is not None else None
+        with self.cond:
+            while True:
+                now = clock()
+                acquire_counter, release_time = self.state
+                if release_time is None or release_time < now:
                     # Either the lock was released or reached its TTL.
                     # Take it.
-                    self.release_time = time() + self.ttl
-                    self.acquire_counter += 1
-                    return self.acquire_counter
-            if give_up is not None and time() >= give_up:
-                # Failed to acquire the lock, return None
-                return None
-            sleep(0.1)  # try not to be a CPU hog
+                    self.state = (acquire_counter + 1, now + self.ttl)
+                    return acquire_counter + 1
+                if give_up is not None and now >= give_up:
+                    # Failed to acquire the lock, return None
+                    return None
+                # Wait to be woken up by a release, but no longer than
+                # it takes for the lock to reach its TTL or for us to
+                # give up.
+                wait_time = release_time - now
+                if give_up is not None:
+                    wait_time = min(wait_time, give_up - now)
+                self.cond.wait(timeout=wait_time)
 
     def release(self, owner_counter):
         """Release the current lock if the caller owns it.
 
         """
-        if owner_counter != self.acquire_counter:
-            # Not the owner of the lock
-            return False
-        with self.thread_lock:
-            # Clear the lock by removing the TTL
-            self.release_time = None
+        with self.cond:
+            acquire_counter, _ = self.state
+            if owner_counter != acquire_counter:
+                # Not the owner of the lock
+                return False
+            # Clear the lock by removing the TTL and let anyone waiting
+            # for it try to take it.
+            self.state = (acquire_counter, None)
+            self.cond.notify_all()
             return True
 
 
@@ -111,6 +163,8 @@ class Lock:
     """Mock implementation of the etcd3 Lock object.
 
     """
+    __slots__ = ('common_lock', 'owner_counter')
+
     def __init__(self, common_lock):
         """ Constructor
 
@@ -132,9 +186,10 @@ class Lock:
         self.release()
         return False  # allow exceptions to propagate (if any)
 
-    def acquire(self, timeout=None):
+    def acquire(self, timeout=10):
         """Acquire the lock using the specified timeout and the lock's TTL
-        value.
+        value.  As with etcd3, a timeout of None waits forever and not
+        specifying one waits for 10 seconds.
 
         """
         self.owner_counter = self.common_lock.acquire(timeout)
@@ -160,124 +215,224 @@ class Etcd3KeyMetadata:
     similar to yield from getprefix.
 
     """
-    def __init__(self, key):
+    __slots__ = (
+        'key', 'create_revision', 'mod_revision', 'version', 'lease_id',
+        'response_header'
+    )
+
+    def __init__(self, key, create_revision=0, mod_revision=0, version=0):
         self.key = key
-        self.create_revision = 0
-        self.mod_revision = 0
-        self.version = 0
+        self.create_revision = create_revision
+        self.mod_revision = mod_revision
+        self.version = version
         self.lease_id = None
         self.response_header = None
 
 
-class Etcd3Client:
+class Put:
+    """A mock version of the etcd3 transaction put operation.
+
+    """
+    __slots__ = ('key', 'value', 'lease')
+
+    def __init__(self, key, value, lease=None):
+        self.key = key
+        self.value = value
+        self.lease = lease
+
+
+class Transactions:
+    """A mock version of the etcd3 helper used to build transaction
+    operations (only put operations are supported).
+
+    """
+    @staticmethod
+    def put(key, value, lease=None):
+        """Build a put operation for use in a transaction.
+
+        """
+        return Put(key, value, lease)
+
+
+class Etcd3Client:  # pylint: disable=too-many-instance-attributes
     """Fake etcd client that can be used for standalone testing of
     interactions with ETCD.  Supports the subset of the ETCD client
     API necessary for testing.  As new uses of ETCD come along,
     add them here for testing.
 
     """
-    def __init__(self, **kwargs):
+    # pylint: disable=unused-argument
+    def __init__(self, host='localhost', port=2379, **kwargs):
         """Create the mock etcd3 client which is implemented as a keystore
-        that simulates ETCD storage.
+        that simulates ETCD storage.  The host and port are kept for
+        reference, any other etcd3 client settings are accepted and
+        ignored.
 
         """
-        # Set up the keystore that will hold the data
+        self.host = host
+        self.port = port
+
+        # Set up the keystore that will hold the data, and a sorted
+        # list of the keys in it for range scans.  Each key holds a
+        # (value, metadata) tuple that is made once when the key is
+        # written and handed back as-is by reads.
         self.keystore = {}
+        self.sorted_keys = []
 
-        # Lock table for this client
+        # Like ETCD, keep a store wide revision that is bumped on
+        # every modification and recorded in the metadata of the keys
+        # it modifies.
+        self.revision = 0
+
+        # Lock table for this client, with its own lock so that
+        # creating locks does not contend with keystore operations.
         self.lock_table = {}
+        self.lock_table_lock = threading.Lock()
+
+        # Helper for building transaction operations
+        self.transactions = Transactions()
 
         # To be thread-safe, we need to be able to lock when doing
-        # things, make a global lock
+        # things to the keystore.  Since every modification bumps the
+        # store wide revision and may change the sorted keys, this is
+        # one lock for the whole keystore.
         self.thread_lock = threading.Lock()
 
         # Set up a place to keep watches, indexed by callback id.  A
-        # watch is a tuple of a key / prefix and a callback.
+        # watch is a tuple of a key / prefix and a callback.  Watches
+        # have their own lock so that looking for watches to call
+        # back does not hold up keystore operations.
+        self.watch_lock = threading.Lock()
         self.next_watch_id = 0
         self.watches = {}
 
-        # Pick up any settings that came in as keyword args
-        for attr, value in kwargs.items():
-            setattr(self, attr, value)
+        # Index the watches so that the ones whose range contains a
+        # given key can be found without looking at all of them.
+        # 'watch_index' holds a (begin, end, watch id) tuple for each
+        # watch sorted by begin, and 'watch_starts' holds just the
+        # begin of each.  Element 'i' of 'watch_max_ends' is the
+        # largest end in watch_index[0..i], which tells us when there
+        # are no more candidates to the left of 'i' in the index.
+        self.watch_index = []
+        self.watch_starts = []
+        self.watch_max_ends = []
 
     def __check_watch(self, key, event):
-        """Check for and generate a watch callback if 'key' is found to be in
-        range of one of the watches that have been set.  The event in
+        """Check for and generate watch callbacks if 'key' is found to be in
+        range of any of the watches that have been set.  The event in
         'event' should be either a 'PutEvent' or a 'DeleteEvent'
         depending on whether the operation was a put or a delete on
         the key.  This should only be called with the lock released
-        and it will call the callback with the lock released)
+        and it will call the callback with the lock released).
 
         """
-        callback = None
-        with self.thread_lock:
-            for _, watch in self.watches.items():
-                begin, end, callback = watch
-                if begin <= key < end:
-                    break
-                callback = None
-        if callback is not None:
-            # pylint: disable=not-callable
+        watch_ids = []
+        with self.watch_lock:
+            # Every watch that can contain 'key' begins at or before
+            # 'key', work left from there until no earlier watch can
+            # reach 'key'.
+            i = bisect_right(self.watch_starts, key)
+            while i > 0 and self.watch_max_ends[i - 1] > key:
+                i -= 1
+                _, end, watch_id = self.watch_index[i]
+                if key < end:
+                    watch_ids.append(watch_id)
+            # Make the callbacks in the order the watches were added
+            callbacks = [self.watches[watch_id][2]
+                         for watch_id in sorted(watch_ids)]
+        for callback in callbacks:
             callback(event)
 
     # pylint: disable=unused-argument
     def get_prefix(self, prefix, sort_order=None, sort_target='key'):
-        """The get_prefix() operation (minimally implemented, no sorting is
-        provided -- add it if you need it later).
+        """The get_prefix() operation (minimally implemented, results always
+        come back in ascending key order, no other sorting is provided
+        -- add it if you need it later).
 
         """
-        keys = []
-        # Lock for the scan to prevent the dictionary from changing
-        # size
-        prefix = bytes(prefix, 'utf-8')
+        # Can't hold the lock while yielding, since yield does not
+        # release it, so take a point-in-time copy of the data under
+        # the lock and yield that back afterward.  The keys starting
+        # with 'prefix' are together in the sorted keys between
+        # 'prefix' and the end of the prefix range.
+        prefix = _key_bytes(prefix)
+        range_end = _prefix_range_end(prefix)
         with self.thread_lock:
-            keys = [key for key in self.keystore if prefix in key]
-
-        # Now go through and yield back the data we think we found
-        for key in keys:
-            # Can't use 'with' locking here because yield does not
-            # release the lock.  Instead we have to lock for each
-            # iteration.  This prevents the keystore from changing
-            # while we check for and grab data from a key.
-            self.thread_lock.acquire()  # pylint: disable=consider-using-with
-
-            # Need to re-check each time because a key might have been
-            # deleted since the previous iteration.
-            if key in self.keystore:
-                item = (self.keystore[key], Etcd3KeyMetadata(key))
-                self.thread_lock.release()
-                yield item
-            else:  # pragma no unit test
-                # We hit a race condition where a key is removed from
-                # the keystore after the start of the get_prefix()
-                # call, in which case we release the lock and iterate
-                # again hoping for better luck on the next key.
-                self.thread_lock.release()
+            sorted_keys = self.sorted_keys
+            start = bisect_left(sorted_keys, prefix)
+            end = (
+                bisect_left(sorted_keys, range_end, lo=start)
+                if range_end is not None else len(sorted_keys)
+            )
+            items = [
+                self.keystore[key] for key in sorted_keys[start:end]
+            ]
+        yield from items
 
     def get(self, key):
         """ The get operation.
         """
-        key = bytes(key, 'utf-8')
+        key = _key_bytes(key)
         with self.thread_lock:
-            if key not in self.keystore:
-                return (None, None)
-            return (self.keystore[key], Etcd3KeyMetadata(key))
+            return self.keystore.get(key, (None, None))
 
     # pylint: disable=unused-argument
     def put(self, key, value, lease=None):
-        """The 'put' operation (minimally supported, no locking semantics, no
-        watch semantics, and no versioning semantics -- add those as
-        needed).
+        """The 'put' operation (minimally supported, no locking semantics
+        and only the revision tracking needed to support object
+        caching -- add more as needed).
 
         """
-        key = bytes(key, 'utf-8')
-        value = bytes(value, 'utf-8')
+        key = _key_bytes(key)
+        value = _value_bytes(value)
         event = None
         with self.thread_lock:
-            self.keystore[key] = value
-            event = PutEvent(key=key, value=self.keystore[key])
+            self.revision += 1
+            event = self.__store(key, value)
         self.__check_watch(key, event)
 
+    def __store(self, key, value):
+        """Store 'value' at 'key' as of the current revision and return the
+        PutEvent describing the change.  This must be called with the
+        lock held and the revision already advanced.
+
+        """
+        create_revision, version = self.revision, 1
+        if key in self.keystore:
+            old_metadata = self.keystore[key][1]
+            create_revision = old_metadata.create_revision
+            version = old_metadata.version + 1
+        else:
+            insort(self.sorted_keys, key)
+        self.keystore[key] = (
+            value,
+            Etcd3KeyMetadata(key, create_revision, self.revision, version)
+        )
+        return PutEvent(key=key, value=value, mod_revision=self.revision)
+
+    # pylint: disable=unused-argument
+    def transaction(self, compare, success=None, failure=None):
+        """The 'transaction' operation (minimally supported, only
+        unconditional transactions made up of put operations are
+        implemented -- add more as needed).  As in ETCD, all of the
+        puts are applied atomically at a single new revision.
+
+        """
+        if compare:  # pragma no cover
+            raise NotImplementedError(
+                "mock etcd3 transactions do not support comparisons"
+            )
+        events = []
+        with self.thread_lock:
+            self.revision += 1
+            for operation in success or []:
+                key = _key_bytes(operation.key)
+                value = _value_bytes(operation.value)
+                events.append(self.__store(key, value))
+        for event in events:
+            self.__check_watch(event.key, event)
+        return True, []
+
     def delete(self, key):
         """The 'delete' operation, delete the key / value from the keystore
         and return True or just return False if the key wasn't there
@@ -286,11 +441,13 @@ class Etcd3Client:
         """
         ret = False
         event = None
-        key = bytes(key, 'utf-8')
+        key = _key_bytes(key)
         with self.thread_lock:
             if key in self.keystore:
-                event = DeleteEvent(key)
+                self.revision += 1
+                event = DeleteEvent(key, mod_revision=self.revision)
                 del self.keystore[key]
+                del self.sorted_keys[bisect_left(self.sorted_keys, key)]
                 ret = True
         if ret:
             self.__check_watch(key, event)
@@ -300,25 +457,32 @@ class Etcd3Client:
         """ Add a watch callback on a key or range of keys.
         """
         ret = 0
-        key = bytes(key, 'utf-8')
+        key = _key_bytes(key)
         if range_end is None:  # pragma no cover
             # The etcd3_model code never sets up a range with node end
             # specified (i.e. a specifically single element range) but
             # handle it anyway.
             range_end = key
         else:
-            range_end = bytes(range_end, 'utf-8')
-        with self.thread_lock:
+            range_end = _key_bytes(range_end)
+        with self.watch_lock:
             ret = self.next_watch_id
             self.next_watch_id += 1
             self.watches[ret] = (key, range_end, callback)
+            insort(self.watch_index, (key, range_end, ret))
+            self.watch_starts = [watch[0] for watch in self.watch_index]
+            self.watch_max_ends = []
+            max_end = b''
+            for watch in self.watch_index:
+                max_end = max(max_end, watch[1])
+                self.watch_max_ends.append(max_end)
         return ret
 
     def lock(self, name, ttl=60):
         """Create a Lock() instance suitable for use as a context manager.
 
         """
-        with self.thread_lock:
+        with self.lock_table_lock:
             if name not in self.lock_table:
                 self.lock_table[name] = CommonLock(name, ttl=ttl,
                                                    etcd_client=self)
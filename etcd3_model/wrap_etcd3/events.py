@@ -28,18 +28,23 @@ class Event:
     """Limited mock up of the etcd3 event key structure
 
     """
-    def __init__(self, key, value=b''):
+    __slots__ = ('key', 'value', 'mod_revision')
+
+    def __init__(self, key, value=b'', mod_revision=0):
         self.key = key
         self.value = value
+        self.mod_revision = mod_revision
 
 
 class PutEvent(Event):
     """Event wrapper to distinguish put events from watch.
 
     """
+    __slots__ = ()
 
 
 class DeleteEvent(Event):
     """Event wrapper to distinguish delete events from watch.
 
     """
+    __slots__ = ()
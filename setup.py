@@ -35,5 +35,11 @@ setup(
     include_package_data=True,
     install_requires=[
         "etcd3",
-    ]
+    ],
+    extras_require={
+        # Optional faster JSON encoding / decoding
+        "fast": [
+            "orjson",
+        ],
+    }
 )
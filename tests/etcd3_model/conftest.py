@@ -0,0 +1,130 @@
+"""
+Shared fixtures for the ETCD Model Base Class tests
+
+MIT License
+
+(C) Copyright [2020] Hewlett Packard Enterprise Development LP
+
+Permission is hereby granted, free of charge, to any person obtaining a
+copy of this software and associated documentation files (the "Software"),
+to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense,
+and/or sell copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included
+in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE."""
+from importlib import import_module
+from time import monotonic
+
+import pytest
+
+from etcd3_model import (
+    create_instance,
+    Etcd3Attr,
+    Etcd3Model
+)
+
+# The 'client' name in the wrap_etcd3 package is the client
+# constructor, so look up the mock client module itself.
+MOCK_CLIENT = import_module("etcd3_model.wrap_etcd3.client")
+
+
+class MockClock:
+    """A stand-in for time.monotonic() in the mock etcd3 client that only
+    moves forward when told to, so tests can run a lock past its TTL
+    without waiting for it.
+
+    """
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        """Move the clock forward by 'seconds'.
+
+        """
+        self.now += seconds
+
+
+@pytest.fixture
+def mock_clock(monkeypatch):
+    """Run the mock etcd3 client's locks on a MockClock for the duration
+    of a test.
+
+    """
+    clock = MockClock(monotonic())
+    monkeypatch.setattr(MOCK_CLIENT, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def etcd():
+    """A mock etcd3 client of the test's very own, so that the keys,
+    watches and locks of one test are never seen by another.
+
+    """
+    return MOCK_CLIENT.client()
+
+
+@pytest.fixture
+def other_etcd():
+    """A second mock etcd3 client of the test's very own, separate from
+    the one provided by the 'etcd' fixture, for tests that need two
+    ETCD instances.
+
+    """
+    return MOCK_CLIENT.client()
+
+
+@pytest.fixture(scope="session")
+def my_base_model_cls():
+    """A legal, basic Etcd3Model derived class, defined once and shared
+    (through my_model_cls) by the tests that just need a plain model
+    to work with.  Tests that watch the model, or depend on specific
+    defaults, should define their own.
+
+    """
+    class MyModel(Etcd3Model):
+        """ Test Model"""
+        etcd_instance = create_instance()
+        model_prefix = "/testing/etcd3model/%s " % ("MyModel")
+
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+        # Some fields...
+        stuff = Etcd3Attr(default="")
+        more_stuff = Etcd3Attr(default="")
+        even_more_stuff = Etcd3Attr(default=0)
+
+    return MyModel
+
+
+# pylint: disable=redefined-outer-name
+@pytest.fixture
+def my_model_cls(request, etcd, my_base_model_cls):
+    """The basic model class from my_base_model_cls, stored in the
+    test's very own mock etcd3 client under a model prefix of the
+    test's very own, so that objects stored by one test are never
+    seen by another.
+
+    """
+    class MyModel(my_base_model_cls):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/MyModel/%s" % (
+            request.node.name
+        )
+
+    return MyModel
@@ -22,9 +22,24 @@ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
 OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
 ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE."""
-from time import sleep
+import abc
+import asyncio
+import dataclasses
+import datetime
+import enum
+from concurrent.futures import Future
+import itertools
+import json
+import math
+import re
+from threading import Thread
+from time import time
 from queue import Empty
+import uuid
 
+import pytest
+
+from etcd3_model.etcd3_model import _log_event_failure
 from etcd3_model import (
     create_instance,
     Etcd3Attr,
@@ -33,45 +48,124 @@ from etcd3_model import (
     UPDATING,
     READY
 )
-ETCD = create_instance()
 
 
-def test_basic_etcd3_locking():
+def drain(queue):
+    """Return everything currently waiting on 'queue' as a list, leaving
+    'queue' empty.
+
+    """
+    drained = []
+    try:
+        while True:
+            drained.append(queue.get_nowait())
+    except Empty:
+        return drained
+
+
+def test_create_instance():
+    """Make sure that creating an ETCD instance more than once shares a
+    single client.
+
+    """
+    assert create_instance() is create_instance()
+
+
+def test_basic_etcd3_locking(mock_clock, etcd):
     """Make sure the underlying locking for etcd3 works as expected.  This
     is mostly here to test the mocking of using a raw etcd3 lock as a
     context manager because the etcd3_model code won't test that.
 
     """
     # Test that the lock works in a simple managed context.
-    with ETCD.lock("foobar") as my_lock:
+    with etcd.lock("foobar") as my_lock:
         assert my_lock.is_acquired()
     assert not my_lock.is_acquired()
 
     # Test that exceeding the TTL causes the lock to drop.
-    with ETCD.lock("foo", ttl=1) as my_lock:
-        sleep(2)
+    with etcd.lock("foo", ttl=1) as my_lock:
+        mock_clock.advance(2)
         assert not my_lock.is_acquired()
     assert not my_lock.is_acquired()
 
 
-def test_basic_instantiation():
-    """Create a basic Etcd3Model derived class instance using a legal
-    class definition.
+def test_lock_handover(etcd):
+    """Make sure that a thread waiting on a held lock acquires it as soon
+    as the holder releases it, without waiting for the TTL.
 
     """
-    class MyModel(Etcd3Model):
-        """ Test Model"""
-        etcd_instance = ETCD
-        model_prefix = "/testing/etcd3model/%s " % ("MyModel")
+    acquired = []
+    with etcd.lock("handover", ttl=60) as my_lock:
+        assert my_lock.is_acquired()
+        waiter = Thread(
+            target=lambda: acquired.append(
+                etcd.lock("handover").acquire(timeout=30)
+            )
+        )
+        waiter.start()
+    start = time()
+    waiter.join()
+    assert acquired == [True]
+    assert time() - start < 10
+
+
+def test_overlapping_watches(etcd):
+    """Make sure that the mock etcd3 makes a callback for every watch
+    whose range contains a changed key, and only for those.
 
-        # The Object ID used to locate each instance
-        my_model_id = Etcd3Attr(is_object_id=True)
+    """
+    seen = []
+    etcd.add_watch_callback("/testing/watch/", lambda event: seen.append(1),
+                            range_end="/testing/watch0")
+    etcd.add_watch_callback("/testing/watch/a/", lambda event: seen.append(2),
+                            range_end="/testing/watch/a0")
+    etcd.add_watch_callback("/testing/watch/b/", lambda event: seen.append(3),
+                            range_end="/testing/watch/b0")
+    etcd.put("/testing/watch/a/key", "value")
+    assert seen == [1, 2]
+    seen.clear()
+    etcd.delete("/testing/watch/b/key")  # not there, no callbacks
+    etcd.put("/testing/watch/b/key", "value")
+    etcd.delete("/testing/watch/b/key")
+    assert seen == [1, 3, 1, 3]
+    seen.clear()
+    etcd.put("/testing/watchers", "value")
+    assert seen == []
+    etcd.delete("/testing/watch/a/key")
+    etcd.delete("/testing/watchers")
+
+
+def test_get_prefix(etcd):
+    """Make sure that the mock etcd3 get_prefix() finds exactly the keys
+    that start with the prefix, in key order.
 
-        # Some fields...
-        stuff = Etcd3Attr(default="")
-        more_stuff = Etcd3Attr(default="")
-        even_more_stuff = Etcd3Attr(default=0)
+    """
+    for key in ["/testing/prefix/b", "/testing/prefix/a",
+                "/testing/prefixed", "/other/testing/prefix/c"]:
+        etcd.put(key, key)
+    found = [meta.key for _, meta in etcd.get_prefix("/testing/prefix/")]
+    assert found == [b"/testing/prefix/a", b"/testing/prefix/b"]
+
+    # The results are a point-in-time view, removing a key part way
+    # through iterating does not drop it from the results.
+    found = []
+    for value, _ in etcd.get_prefix("/testing/prefix/"):
+        etcd.delete("/testing/prefix/b")
+        found.append(value)
+    assert found == [b"/testing/prefix/a", b"/testing/prefix/b"]
+    for key in ["/testing/prefix/b", "/testing/prefix/a",
+                "/testing/prefixed", "/other/testing/prefix/c"]:
+        etcd.delete(key)
+    assert list(etcd.get_prefix("/testing/prefix")) == []
 
+
+# pylint: disable=redefined-outer-name
+def test_basic_instantiation(mock_clock, my_model_cls):
+    """Create a basic Etcd3Model derived class instance using a legal
+    class definition.
+
+    """
+    MyModel = my_model_cls  # pylint: disable=invalid-name
     my_model = MyModel(stuff="here is some stuff",
                        more_stuff="here is some more stuff",
                        even_more_stuff="here is even more stuff")
@@ -86,60 +180,43 @@ def test_basic_instantiation():
 
     # Get it back again in a different instance and compare the
     # instances
+    expected = {
+        attr: getattr(my_model, attr)
+        for attr in ["my_model_id", "stuff", "more_stuff", "even_more_stuff"]
+    }
     retrieved = MyModel.get(my_model.my_model_id)
     assert retrieved is not None
-    assert retrieved.my_model_id == my_model.my_model_id
-    assert retrieved.stuff == my_model.stuff
-    assert retrieved.more_stuff == my_model.more_stuff
-    assert retrieved.even_more_stuff == my_model.even_more_stuff
+    assert {attr: getattr(retrieved, attr) for attr in expected} == expected
     assert retrieved.get_id() == my_model.my_model_id
 
     # Get all MyModel instances and make sure ours is (the only one)
     # there
     all_models = MyModel.get_all()
-    assert isinstance(all_models, type([]))
+    assert isinstance(all_models, list)
     assert len(all_models) == 1
     retrieved = all_models[0]
     assert retrieved is not None
-    assert retrieved.my_model_id == my_model.my_model_id
-    assert retrieved.stuff == my_model.stuff
-    assert retrieved.more_stuff == my_model.more_stuff
-    assert retrieved.even_more_stuff == my_model.even_more_stuff
+    assert {attr: getattr(retrieved, attr) for attr in expected} == expected
 
     # Post a message to it and make sure the message gets posted
     msg = "hello world!"
     my_model.post_message(msg)
-    found = False
-    for message in my_model.messages:
-        if msg in message:
-            found = True
-    assert found
-    retrieved = MyModel.get(my_model.my_model_id)
-    found = False
-    for message in retrieved.messages:
-        if msg in message:
-            found = True
-    assert found
+    assert any(msg in message for message in my_model.messages)
 
     # Post a one-time message several times and make sure it only
     # shows up once
-    msg = "should only appear once"
-    my_model.post_message_once(msg)
-    my_model.post_message_once(msg)
-    my_model.post_message_once(msg)
-    my_model.post_message_once(msg)
-    my_model.post_message_once(msg)
-    found = 0
-    for message in my_model.messages:
-        if msg in message:
-            found += 1
-    assert found == 1
+    once_msg = "should only appear once"
+    my_model.post_message_once(once_msg)
+    my_model.post_message_once(once_msg)
+    my_model.post_message_once(once_msg)
+    my_model.post_message_once(once_msg)
+    my_model.post_message_once(once_msg)
+    assert sum(once_msg in message for message in my_model.messages) == 1
+
+    # Both messages should have been stored
     retrieved = MyModel.get(my_model.my_model_id)
-    found = 0
-    for message in retrieved.messages:
-        if msg in message:
-            found += 1
-    assert found == 1
+    assert any(msg in message for message in retrieved.messages)
+    assert sum(once_msg in message for message in retrieved.messages) == 1
 
     # Try some locking to make sure the locking mechanisms work
     with my_model.lock(ttl=2) as my_lock:
@@ -158,12 +235,23 @@ def test_basic_instantiation():
     # context so it is not held at the end.
     with my_model.lock(ttl=2) as my_lock:
         assert my_lock.is_acquired()
+        mock_clock.advance(3)
         with my_model.lock(ttl=2) as my_second_lock:
             assert not my_lock.is_acquired()
             assert my_second_lock.is_acquired()
         assert not my_second_lock.is_acquired()
     assert not my_lock.is_acquired()
 
+    # Make sure the lock can also be used from asyncio code
+    async def async_locking():
+        async with my_model.async_lock(ttl=2) as my_lock:
+            assert my_lock.is_acquired()
+            async with my_model.async_lock(timeout=0) as my_second_lock:
+                assert not my_second_lock.is_acquired()
+            assert my_lock.is_acquired()
+        return my_lock
+    assert not asyncio.run(async_locking()).is_acquired()
+
     # Set it to READY and make sure the messages go away and the state
     # goes to READY.  Do this under lock to test locking as well...
     my_model.set_ready()
@@ -179,11 +267,7 @@ def test_basic_instantiation():
     assert my_model.state == DELETING
     retrieved = MyModel.get(my_model.my_model_id)
     assert retrieved.state == DELETING
-    found = False
-    for message in retrieved.messages:
-        if msg in message:
-            found = True
-    assert found
+    assert any(msg in message for message in retrieved.messages)
 
     # Remove it and make sure it is gone
     my_model.remove()
@@ -193,12 +277,398 @@ def test_basic_instantiation():
     # And, for good measure, make sure it doesn't show up in the list
     # either
     all_models = MyModel.get_all()
-    assert isinstance(all_models, type([]))
+    assert isinstance(all_models, list)
     assert all_models == []
 
 
 # pylint: disable=redefined-outer-name
-def test_field_defaults():
+def test_retrieved_objects(my_model_cls):
+    """Show that retrieving the same object more than once always
+    produces separate objects, that changes to a retrieved object are
+    not seen by later retrievals unless they are stored, and that
+    stored changes are seen.
+
+    """
+    MyRetrieveModel = my_model_cls  # pylint: disable=invalid-name
+    my_model = MyRetrieveModel(stuff="original stuff")
+    my_model.put()
+    first = MyRetrieveModel.get(my_model.my_model_id)
+    second = MyRetrieveModel.get(my_model.my_model_id)
+    assert first is not second
+    assert first.messages is not second.messages
+    assert second.stuff == "original stuff"
+
+    # Change the first one without storing it, the change should not
+    # show up in a later retrieval.
+    first.stuff = "changed stuff"
+    first.messages.append("not stored")
+    retrieved = MyRetrieveModel.get(my_model.my_model_id)
+    assert retrieved.stuff == "original stuff"
+    assert retrieved.messages == []
+
+    # Now store the change and make sure it does show up.
+    first.put()
+    retrieved = MyRetrieveModel.get(my_model.my_model_id)
+    assert retrieved.stuff == "changed stuff"
+    assert retrieved.messages == ["not stored"]
+    all_models = MyRetrieveModel.get_all()
+    assert len(all_models) == 1
+    assert all_models[0].stuff == "changed stuff"
+
+    # Remove it and make sure nothing brings it back.
+    first.remove()
+    assert MyRetrieveModel.get(my_model.my_model_id) is None
+    assert MyRetrieveModel.get_all() == []
+
+
+# pylint: disable=redefined-outer-name
+def test_retrieved_initializer(etcd):
+    """Show that objects retrieved are always built through the model's
+    initializer, so that run-time state the initializer sets up is
+    never shared between objects.
+
+    """
+    class MyInitModel(Etcd3Model):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/%s" % ("MyInitModel")
+
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+        # Count of the objects built
+        built = 0
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            MyInitModel.built += 1
+            self.scratch = []
+
+    my_model = MyInitModel()
+    my_model.put()
+    first = MyInitModel.get(my_model.my_model_id)
+    second = MyInitModel.get(my_model.my_model_id)
+    assert MyInitModel.built == 3
+    first.scratch.append("first only")
+    assert second.scratch == []
+    my_model.remove()
+
+
+# pylint: disable=redefined-outer-name
+def test_switch_etcd_instance(etcd, other_etcd):
+    """Show that an object retrieved after switching a model to a
+    different ETCD instance comes from the new instance, even when
+    the same key was stored at the same revision in both.
+
+    """
+    class MySwitchModel(Etcd3Model):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/%s" % ("MySwitchModel")
+
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+        # Some fields...
+        stuff = Etcd3Attr(default=None)
+
+    my_model = MySwitchModel(stuff="first instance")
+    my_model.put()
+    assert MySwitchModel.get(my_model.my_model_id).stuff == "first instance"
+    MySwitchModel.etcd_instance = other_etcd
+    my_model.stuff = "second instance"
+    my_model.put()
+    assert MySwitchModel.get(my_model.my_model_id).stuff == "second instance"
+    assert [
+        model.stuff for model in MySwitchModel.get_all()
+    ] == ["second instance"]
+    my_model.remove()
+    MySwitchModel.etcd_instance = etcd
+    assert MySwitchModel.get(my_model.my_model_id).stuff == "first instance"
+    my_model.remove()
+
+
+# pylint: disable=redefined-outer-name,unsubscriptable-object
+@dataclasses.dataclass
+class JsonPoint:
+    """A dataclass the standard library JSON encoder can't encode.
+
+    """
+    horizontal: int
+    vertical: int
+
+
+class JsonColor(enum.Enum):
+    """An enum the standard library JSON encoder can't encode.
+
+    """
+    RED = 1
+
+
+def test_json_values(etcd):
+    """Show that values the standard library JSON encoder handles, but a
+    faster encoder might not handle the same way, are stored and read
+    back unchanged, and that such values written by the standard
+    library encoder are read back correctly.
+
+    """
+    class MyJsonModel(Etcd3Model):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/%s" % ("MyJsonModel")
+
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+        # Some fields...
+        value = Etcd3Attr(default=None)
+
+    for value in [2 ** 70, -2 ** 70, float("inf"), [1.5, None], "null",
+                  {"nested": [2 ** 64]}, 1e300]:
+        my_model = MyJsonModel(value=value)
+        my_model.put()
+        assert MyJsonModel.get(my_model.my_model_id).value == value
+        etcd.put(
+            "/testing/etcd3model/MyJsonModel/%s" % my_model.my_model_id,
+            json.dumps({"my_model_id": my_model.my_model_id, "value": value})
+        )
+        assert MyJsonModel.get(my_model.my_model_id).value == value
+        my_model.remove()
+    my_model = MyJsonModel(value=[float("nan")])
+    my_model.put()
+    assert math.isnan(MyJsonModel.get(my_model.my_model_id).value[0])
+    my_model.remove()
+    for value in [
+            datetime.datetime.now(), uuid.uuid4(), JsonPoint(1, 2),
+            JsonColor.RED, [{"nested": JsonColor.RED}], {uuid.uuid4(): 1},
+    ]:
+        my_model = MyJsonModel(value=value)
+        with pytest.raises(TypeError):
+            my_model.put()
+        assert MyJsonModel.get(my_model.my_model_id) is None
+
+
+def test_event_failure_logged(caplog):
+    """Show that an exception raised handling a watch event on the event
+    worker thread is logged rather than lost.
+
+    """
+    future = Future()
+    future.set_result(None)
+    _log_event_failure(future)
+    assert not caplog.records
+    future = Future()
+    future.set_exception(ValueError("bad event"))
+    _log_event_failure(future)
+    assert "failed to handle ETCD watch event" in caplog.text
+    assert "bad event" in caplog.text
+
+
+# pylint: disable=redefined-outer-name
+def test_late_class_settings(etcd):
+    """Show that 'etcd_instance' and 'model_prefix' may be set on a model
+    class after it is defined, and that changing 'model_prefix' moves
+    where objects are stored.
+
+    """
+    class MyLateModel(Etcd3Model):
+        """ Test Model"""
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+    with pytest.raises(AttributeError, match=MISSING_ETCD_INSTANCE):
+        MyLateModel()
+    MyLateModel.etcd_instance = etcd
+    MyLateModel.model_prefix = "/testing/etcd3model/%s" % ("MyLateModel")
+    my_model = MyLateModel()
+    my_model.put()
+    assert MyLateModel.get(my_model.my_model_id) is not None
+    MyLateModel.model_prefix = "/testing/etcd3model/%s" % ("MyMovedModel")
+    assert MyLateModel.get(my_model.my_model_id) is None
+    my_model = MyLateModel()
+    my_model.put()
+    assert etcd.get(
+        "/testing/etcd3model/MyMovedModel/%s" % my_model.my_model_id
+    )[0] is not None
+    my_model.remove()
+    del MyLateModel.model_prefix
+    with pytest.raises(AttributeError, match=MISSING_MODEL_PREFIX):
+        MyLateModel()
+
+
+# pylint: disable=redefined-outer-name
+def test_abstract_base_mixin(etcd):
+    """Show that a model class may also derive from an abstract base
+    class (a class with its own metaclass).
+
+    """
+    class Describable(abc.ABC):
+        """An abstract base class to mix into a model."""
+        @abc.abstractmethod
+        def describe(self):
+            """Describe the object."""
+
+    class MyAbcModel(Etcd3Model, Describable):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/%s" % ("MyAbcModel")
+
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+        def describe(self):
+            return "MyAbcModel %s" % self.my_model_id
+
+    my_model = MyAbcModel()
+    my_model.put()
+    retrieved = MyAbcModel.get(my_model.my_model_id)
+    assert isinstance(retrieved, Describable)
+    assert retrieved.describe() == my_model.describe()
+    my_model.remove()
+
+
+# pylint: disable=redefined-outer-name
+def test_batched_puts(etcd):
+    """Show that puts within a batched() context are held until the
+    context exits and then stored once per object with the latest
+    state of the object.
+
+    """
+    class MyBatchModel(Etcd3Model):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/%s" % ("MyBatchModel")
+
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+    queue = MyBatchModel.watch()
+    instances = [MyBatchModel() for i in range(0, 3)]
+    removed = MyBatchModel()
+    with MyBatchModel.batched():
+        for instance in instances:
+            instance.post_message("first")
+        with Etcd3Model.batched():
+            for instance in instances:
+                instance.post_message("second")
+        removed.put()
+        removed.remove()
+        # Nothing is stored until the outermost context exits
+        assert MyBatchModel.get_all() == []
+        assert queue.empty()
+
+    # Each object shows up (once) in its latest state, and the removed
+    # one does not show up at all.
+    instance_ids = {instance.my_model_id for instance in instances}
+    for instance in MyBatchModel.get_all():
+        assert instance.messages == ["first", "second"]
+        assert instance.my_model_id in instance_ids
+        instance_ids.discard(instance.my_model_id)
+    assert not instance_ids
+    instance_ids = {instance.my_model_id for instance in instances}
+    for observed in drain(queue):
+        assert observed.messages == ["first", "second"]
+        assert observed.my_model_id in instance_ids
+        instance_ids.discard(observed.my_model_id)
+    assert not instance_ids
+    for instance in instances:
+        instance.remove()
+
+    # If the batched context raises, nothing in it is stored
+    with pytest.raises(ValueError):
+        with MyBatchModel.batched():
+            instances[0].put()
+            raise ValueError("stop")
+    assert MyBatchModel.get_all() == []
+    assert queue.empty()
+    instances[0].put()
+    assert len(MyBatchModel.get_all()) == 1
+    instances[0].remove()
+
+
+# pylint: disable=redefined-outer-name
+def test_batched_puts_two_instances(etcd, other_etcd):
+    """Show that batched puts of objects stored at the same key in two
+    different ETCD instances are all stored, and that removing one
+    of them while batching leaves the other alone.
+
+    """
+    class MyFirstModel(Etcd3Model):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/%s" % ("MyTwinModel")
+
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+    class MySecondModel(MyFirstModel):
+        """ Test Model"""
+        etcd_instance = other_etcd
+        model_prefix = MyFirstModel.model_prefix
+
+    first = MyFirstModel()
+    second = MySecondModel(my_model_id=first.my_model_id)
+    with Etcd3Model.batched():
+        first.put()
+        second.put()
+    assert MyFirstModel.get(first.my_model_id) is not None
+    assert MySecondModel.get(second.my_model_id) is not None
+    with Etcd3Model.batched():
+        first.put()
+        second.put()
+        first.remove()
+    assert MyFirstModel.get(first.my_model_id) is None
+    assert MySecondModel.get(second.my_model_id) is not None
+    second.remove()
+
+
+# pylint: disable=redefined-outer-name
+def test_mutate(etcd):
+    """Show that mutate() and delete() with a list of messages apply
+    all of their changes in a single put.
+
+    """
+    class MyMutateModel(Etcd3Model):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/%s" % ("MyMutateModel")
+
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+    queue = MyMutateModel.watch()
+    my_model = MyMutateModel()
+    my_model.mutate(state=UPDATING, append_messages=["one", "two"])
+    observed = queue.get_nowait()
+    assert observed.messages == ["one", "two"]
+    assert queue.empty()
+
+    my_model.mutate(set_ready=True, state=DELETING,
+                    append_messages=["three"])
+    observed = queue.get_nowait()
+    assert observed.state == DELETING
+    assert observed.messages == ["three"]
+    assert queue.empty()
+
+    my_model.delete(["four", "", "five"])
+    observed = queue.get_nowait()
+    assert observed.state == DELETING
+    assert observed.messages == ["three", "four", "five"]
+    assert queue.empty()
+
+    # A bad message is caught before anything is changed
+    with pytest.raises(AssertionError):
+        my_model.mutate(set_ready=True, append_messages=["ok", ""])
+    assert my_model.state == DELETING
+    assert my_model.messages == ["three", "four", "five"]
+    with pytest.raises(AssertionError):
+        my_model.delete(42)
+    assert queue.empty()
+    my_model.remove()
+
+
+# pylint: disable=redefined-outer-name
+def test_field_defaults(etcd):
     """Test defining a model with a non-standard object id generator and
     show that the generator generates the expected sequence of
     object-ids.
@@ -206,7 +676,7 @@ def test_field_defaults():
     """
     class MyModel(Etcd3Model):
         """ Test Model"""
-        etcd_instance = ETCD
+        etcd_instance = etcd
         model_prefix = "/testing/etcd3model/%s " % ("MyModel")
 
         # The Object ID used to locate each instance
@@ -224,26 +694,53 @@ def test_field_defaults():
     assert my_model.even_more_stuff == "even more default stuff"
 
 
+# pylint: disable=redefined-outer-name,unsupported-assignment-operation
+# pylint: disable=unsubscriptable-object
+def test_mutable_field_defaults(etcd):
+    """Test defining a model with mutable default values and show that
+    instances do not share those values with each other or with the
+    model definition.
+
+    """
+    class MyModel(Etcd3Model):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/%s " % ("MyModel")
+
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True)
+
+        # Some fields...
+        flat_list = Etcd3Attr(default=["a", "b"])
+        flat_dict = Etcd3Attr(default={"a": 1})
+        nested = Etcd3Attr(default={"a": [1, 2]})
+        frozen = Etcd3Attr(default=("a", 1))
+
+    first = MyModel()
+    second = MyModel()
+    first.flat_list.append("c")
+    first.flat_dict["b"] = 2
+    first.nested["a"].append(3)
+    assert second.flat_list == ["a", "b"]
+    assert second.flat_dict == {"a": 1}
+    assert second.nested == {"a": [1, 2]}
+    assert first.frozen is second.frozen
+    assert MyModel().nested == {"a": [1, 2]}
+
+
 # pylint: disable=redefined-outer-name
-def test_object_id_default():
+def test_object_id_default(etcd):
     """Test defining a model with a non-standard object id generator and
     show that the generator generates the expected sequence of
     object-ids.
 
     """
-    next_obj_id = 0
-
-    def object_id_gen():
-        """ Example non-default object-id generator.
-        """
-        nonlocal next_obj_id
-        ret = next_obj_id
-        next_obj_id += 1
-        return ret
+    # Example non-default object-id generator.
+    object_id_gen = itertools.count().__next__
 
     class MyModel(Etcd3Model):
         """ Test Model"""
-        etcd_instance = ETCD
+        etcd_instance = etcd
         model_prefix = "/testing/etcd3model/%s " % ("MyModel")
 
         # The Object ID used to locate each instance
@@ -262,7 +759,7 @@ def test_object_id_default():
 
 
 # pylint: disable=redefined-outer-name
-def test_watch_and_learn():
+def test_watch_and_learn(etcd):
     """Test watching and learning of ETCD model objects.  Verify that
     watching an object of a given type causes put events to flow down
     the queue associated with the object class but not down any queue
@@ -274,7 +771,7 @@ def test_watch_and_learn():
     """
     class MyWatchModel(Etcd3Model):
         """ Test Model"""
-        etcd_instance = ETCD
+        etcd_instance = etcd
         model_prefix = "/testing/etcd3model/%s" % ("MyWatchModel")
 
         # The Object ID used to locate each instance
@@ -282,7 +779,7 @@ def test_watch_and_learn():
 
     class MyOtherModel(Etcd3Model):
         """ Test Model"""
-        etcd_instance = ETCD
+        etcd_instance = etcd
         model_prefix = "/testing/etcd3model/%s" % ("MyOtherModel")
 
         # The Object ID used to locate each instance
@@ -296,8 +793,7 @@ def test_watch_and_learn():
 
     # Actually put the new objects into ETCD, they should flow down
     # 'queue' as they are created.
-    for instance in instances:
-        instance.put()
+    MyWatchModel.put_many(instances)
 
     # Set up watching on MyOtherModel
     other_queue = MyOtherModel.watch()
@@ -307,58 +803,35 @@ def test_watch_and_learn():
 
     # Actually put the new objects into ETCD, they should flow down
     # 'other_queue' as they are created.
-    for instance in other_instances:
-        instance.put()
+    MyOtherModel.put_many(other_instances)
 
     # Check that all of the MyWatchModel instances flowed down 'queue'
     # exactly once and that nothing unexpected flowed down 'queue'
-    done = False
-    instance_ids = [instance.my_model_id for instance in instances]
-    while not done:
-        try:
-            observed = queue.get_nowait()
-            assert isinstance(observed, MyWatchModel)
-            assert observed.my_model_id in instance_ids
-            instance_ids.remove(observed.my_model_id)
-        except Empty:
-            done = True
-    assert instance_ids == []
+    instance_ids = sorted(instance.my_model_id for instance in instances)
+    observed = drain(queue)
+    assert all(isinstance(item, MyWatchModel) for item in observed)
+    assert sorted(item.my_model_id for item in observed) == instance_ids
 
     # Check that all of the MyWatchModel instances also flowed down
     # 'second_queue' exactly once and that nothing unexpected flowed
     # down 'second_queue'
-    done = False
-    instance_ids = [instance.my_model_id for instance in instances]
-    while not done:
-        try:
-            observed = second_queue.get_nowait()
-            assert isinstance(observed, MyWatchModel)
-            assert observed.my_model_id in instance_ids
-            instance_ids.remove(observed.my_model_id)
-        except Empty:
-            done = True
-    assert instance_ids == []
+    observed = drain(second_queue)
+    assert all(isinstance(item, MyWatchModel) for item in observed)
+    assert sorted(item.my_model_id for item in observed) == instance_ids
 
     # Check that all of the MyOtherModel instances flowed down
     # 'other_queue' exactly once and that nothing unexpected flowed
     # down 'other_queue'
-    done = False
-    instance_ids = [instance.my_model_id for instance in other_instances]
-    while not done:
-        try:
-            observed = other_queue.get_nowait()
-            assert isinstance(observed, MyOtherModel)
-            assert observed.my_model_id in instance_ids
-            instance_ids.remove(observed.my_model_id)
-        except Empty:
-            done = True
-    assert instance_ids == []
+    other_ids = sorted(instance.my_model_id for instance in other_instances)
+    observed = drain(other_queue)
+    assert all(isinstance(item, MyOtherModel) for item in observed)
+    assert sorted(item.my_model_id for item in observed) == other_ids
 
     # Set all of the MyWatchModel instances to the READY state, and show
     # that 'queue' remains quiet.
     for instance in instances:
         instance.state = READY
-        instance.put()
+    MyWatchModel.put_many(instances)
     assert queue.empty()
 
     # Remove all of the MyOtherModel instances and show that
@@ -369,98 +842,63 @@ def test_watch_and_learn():
 
     # Now, try to 'learn' all of the MyWatchModel instances and verify that
     # they all come down the queue.
-    #
-    # Gather the instance ids again...
-    instance_ids = [instance.my_model_id for instance in instances]
-
-    # Kick off the learn...
     MyWatchModel.learn()
     # Check that all of the MyWatchModel instances flowed down 'queue'
     # exactly once and that nothing unexpected flowed down 'queue'
-    done = False
-    while not done:
-        try:
-            observed = queue.get_nowait()
-            assert isinstance(observed, MyWatchModel)
-            assert observed.state in [UPDATING, DELETING]
-            assert observed.my_model_id in instance_ids
-            instance_ids.remove(observed.my_model_id)
-        except Empty:
-            done = True
-    assert instance_ids == []
-
-
-# pylint: disable=redefined-outer-name,unused-argument
-def test_bad_object_id_default():
-    """Test defining a model with a non-callable object id generator
-    and show that instantiation fails as expected.
+    observed = drain(queue)
+    assert all(isinstance(item, MyWatchModel) for item in observed)
+    assert all(item.state in [UPDATING, DELETING] for item in observed)
+    assert sorted(item.my_model_id for item in observed) == instance_ids
+
+
+# Expected messages from misconfigured models, see test_bad_model()
+BAD_OID_DEFAULT = re.compile(r"'default' for Object ID is not callable")
+MISSING_OID = re.compile(r"must have an Object ID in")
+TWO_OIDS = re.compile(r"can't have two Object IDs in")
+MISSING_ETCD_INSTANCE = re.compile(
+    r"missing required attribute 'etcd_instance'"
+)
+MISSING_MODEL_PREFIX = re.compile(r"missing required attribute 'model_prefix'")
+
+
+def make_bad_object_id_default(etcd):
+    """Define a model with a non-callable object id generator.
 
     """
-    try:
-        class MyModel(Etcd3Model):
-            """ Test Model"""
-            # The Object ID used to locate each instance
-            my_model_id = Etcd3Attr(is_object_id=True,
-                                    default="fixed string(bad)")
-        # If this is working right, it will cause an exception which
-        # will prevent it from being counted in the coverage report,
-        # hence the pragma.
-        MyModel(stuff="here is some stuff",        # pragma no cover
-                more_stuff="here is some more stuff",
-                even_more_stuff="here is even more stuff")
-    except ValueError as exc:
-        assert "'default' for Object ID is not callable" in str(exc)
-    # We really want to catch all exceptions here and fail if we get
-    # one.
-    #
-    # pylint: disable=broad-except
-    except Exception:  # pragma unit test failure
-        assert False
-    else:  # pragma unit test failure
-        assert False
+    class MyModel(Etcd3Model):
+        """ Test Model"""
+        etcd_instance = etcd
+        model_prefix = "/testing/etcd3model/%s " % ("MyModel")
 
+        # The Object ID used to locate each instance
+        my_model_id = Etcd3Attr(is_object_id=True,
+                                default="fixed string(bad)")
+    return MyModel  # pragma no cover
 
-# pylint: disable=redefined-outer-name
-def test_missing_object_id():
-    """Test instantiating a model that has no object id field.  Should
-    get an AttributeError exception and a specific string
+
+def make_missing_object_id(etcd):
+    """Define a model that has no object id field.
 
     """
     class MyModel(Etcd3Model):
         """ Test Model"""
-        etcd_instance = ETCD
+        etcd_instance = etcd
         model_prefix = "/testing/etcd3model/%s " % ("MyModel")
 
         # Some fields...
         stuff = Etcd3Attr(default="")
         more_stuff = Etcd3Attr(default="")
         even_more_stuff = Etcd3Attr(default=0)
+    return MyModel
 
-    try:
-        MyModel(stuff="here is some stuff",
-                more_stuff="here is some more stuff",
-                even_more_stuff="here is even more stuff")
-    except AttributeError as exc:
-        assert "must have an Object ID in" in str(exc)
-    # We really want to catch all exceptions here and fail if we get
-    # one.
-    #
-    # pylint: disable=broad-except
-    except Exception:  # pragma unit test failure
-        assert False
-    else:  # pragma unit test failure
-        assert False
 
+def make_two_object_ids(etcd):
+    """Define a model with two different object id fields.
 
-# pylint: disable=redefined-outer-name
-def test_two_object_ids():
-    """Test instantiating a model with two different object id fields.
-    Should get an AssertionError with a specific string.
-
-  """
+    """
     class MyModel(Etcd3Model):
         """ Test Model"""
-        etcd_instance = ETCD
+        etcd_instance = etcd
         model_prefix = "/testing/etcd3model/%s " % ("MyModel")
 
         # The Object ID used to locate each instance
@@ -473,28 +911,13 @@ def test_two_object_ids():
         stuff = Etcd3Attr(default="")
         more_stuff = Etcd3Attr(default="")
         even_more_stuff = Etcd3Attr(default=0)
-    try:
-        MyModel(stuff="here is some stuff",
-                more_stuff="here is some more stuff",
-                even_more_stuff="here is even more stuff")
-    except AssertionError as exc:
-        assert "can't have two Object IDs in" in str(exc)
-    # We really want to catch all exceptions here and fail if we get
-    # one.
-    #
-    # pylint: disable=broad-except
-    except Exception:  # pragma unit test failure
-        assert False
-    else:  # pragma unit test failure
-        assert False
-
-
-# pylint: disable=redefined-outer-name,unused-argument
-def test_missing_etcd_instance():
-    """Test instantiating a model without an 'etcd_instance' specified
-    Should get an AttributeError with a specific string.
-
-  """
+    return MyModel
+
+
+def make_missing_etcd_instance(_etcd):
+    """Define a model without an 'etcd_instance' specified.
+
+    """
     class MyModel(Etcd3Model):
         """ Test Model"""
         model_prefix = "/testing/etcd3model/%s " % ("MyModel")
@@ -506,31 +929,16 @@ def test_missing_etcd_instance():
         stuff = Etcd3Attr(default="")
         more_stuff = Etcd3Attr(default="")
         even_more_stuff = Etcd3Attr(default=0)
-    try:
-        MyModel(stuff="here is some stuff",
-                more_stuff="here is some more stuff",
-                even_more_stuff="here is even more stuff")
-    except AttributeError as exc:
-        assert "missing required attribute 'etcd_instance'" in str(exc)
-    # We really want to catch all exceptions here and fail if we get
-    # one.
-    #
-    # pylint: disable=broad-except
-    except Exception:  # pragma unit test failure
-        assert False
-    else:  # pragma unit test failure
-        assert False
+    return MyModel
 
 
-# pylint: disable=redefined-outer-name
-def test_missing_model_prefix():
-    """Test instantiating a model without a 'model_prefix' specified
-    Should get an AttributeError with a specific string.
+def make_missing_model_prefix(etcd):
+    """Define a model without a 'model_prefix' specified.
 
-  """
+    """
     class MyModel(Etcd3Model):
         """ Test Model"""
-        etcd_instance = ETCD
+        etcd_instance = etcd
 
         # The Object ID used to locate each instance
         my_model_id = Etcd3Attr(is_object_id=True)
@@ -539,17 +947,36 @@ def test_missing_model_prefix():
         stuff = Etcd3Attr(default="")
         more_stuff = Etcd3Attr(default="")
         even_more_stuff = Etcd3Attr(default=0)
-    try:
-        MyModel(stuff="here is some stuff",
-                more_stuff="here is some more stuff",
-                even_more_stuff="here is even more stuff")
-    except AttributeError as exc:
-        assert "missing required attribute 'model_prefix'" in str(exc)
-    # We really want to catch all exceptions here and fail if we get
-    # one.
-    #
-    # pylint: disable=broad-except
-    except Exception:  # pragma unit test failure
-        assert False
-    else:  # pragma unit test failure
-        assert False
+    return MyModel
+
+
+@pytest.mark.parametrize(
+    "factory,exc,match",
+    [
+        (make_bad_object_id_default, ValueError, BAD_OID_DEFAULT),
+        (make_missing_object_id, AttributeError, MISSING_OID),
+        (make_two_object_ids, AssertionError, TWO_OIDS),
+        (make_missing_etcd_instance, AttributeError, MISSING_ETCD_INSTANCE),
+        (make_missing_model_prefix, AttributeError, MISSING_MODEL_PREFIX),
+    ]
+)
+def test_bad_model(factory, exc, match, etcd):
+    """Test defining and instantiating a misconfigured model and show
+    that it fails with the expected exception and message.  Some
+    mistakes are caught when the model is defined, others when it is
+    first instantiated, so both happen under pytest.raises().
+
+    """
+    with pytest.raises(exc, match=match):
+        factory(etcd)(stuff="here is some stuff",
+                      more_stuff="here is some more stuff",
+                      even_more_stuff="here is even more stuff")
+
+
+def test_instantiate_base_model():
+    """Show that trying to instantiate Etcd3Model itself fails the same
+    way as instantiating a model class with no 'etcd_instance'.
+
+    """
+    with pytest.raises(AttributeError, match=MISSING_ETCD_INSTANCE):
+        Etcd3Model()